@@ -18,6 +18,8 @@ class MistsConfig(PretrainedConfig):
         # time_series_feature_select_strategy="default",  # TODO: modelのforward用(画像モデルのhidden_stateからEmbeddingをどう取得するか)。将来的に対応。
         # time_series_feature_layer=-2,  # modelのforward用  # TODO: modelのforward用(画像モデルのhidden_stateからEmbeddingをどう取得するか)。将来的に対応。
         time_series_hidden_size=1024,  # projector用
+        max_time_series_tokens=None,  # 1サンプルあたりのtime_series token数の上限。設定するとmerge後の系列長が入力に依らず固定になる。Noneの場合はbatch内の最大数を使う。
+        reuse_merge_buffers=False,  # 推論時にmergeの出力バッファをthreadごとに使い回す。threadが生きている間はバッファ分のメモリを保持し続ける。
         **kwargs,
     ):
         
@@ -25,6 +27,8 @@ class MistsConfig(PretrainedConfig):
         self.time_series_token_index = time_series_token_index
         self.projector_hidden_act = projector_hidden_act
         self.time_series_hidden_size = time_series_hidden_size
+        self.max_time_series_tokens = max_time_series_tokens
+        self.reuse_merge_buffers = reuse_merge_buffers
 
         # 将来的に、MomentモデルがTransformersに登録されることを想定して追加する
         # そのため、CONFIG_MAPPINGは機能しない。
@@ -1,3 +1,6 @@
+import math
+import threading
+import weakref
 from dataclasses import dataclass
 from typing import List, Optional, Tuple, Union
 
@@ -21,6 +24,10 @@ from .modeling_moment import MomentEmbeddingModel
 from .configuration_mists import MistsConfig
 
 
+# mergeの出力バッファの保持先。threadごとに{model: {name: buffer}}を持ち、threadの終了やmodelの破棄とともに解放される。
+_merge_buffers = threading.local()
+
+
 @dataclass
 # Copied from transformers.models.idefics.modeling_idefics.IdeficsCausalLMOutputWithPast with Idefics->Mists
 class MistsCausalLMOutputWithPast(ModelOutput):
@@ -44,9 +51,32 @@ class MistsMultiModalProjector(nn.Module):
         self.act = ACT2FN[config.projector_hidden_act]
         self.linear_2 = nn.Linear(config.text_config.hidden_size, config.text_config.hidden_size, bias=True)
 
-    def forward(self, time_series_features, input_mask):
-        masked_features = time_series_features * input_mask.unsqueeze(-1) + self.mask_embedding * (1 - input_mask.unsqueeze(-1))
-        hidden_states = self.linear_1(masked_features)
+    def forward(self, time_series_features, input_mask, allow_sparse=True):
+        # mask位置の出力はmask_embeddingのみで決まる定数ベクトルになる。maskが疎な場合はMLPを有効なpatchに対してのみ計算し、
+        # mask位置にはmask_embeddingを1度だけ射影したベクトルをbroadcastする。
+        # 疎な経路は有効patchの抽出(nonzero)でhost-device syncが1回発生し、gather/scatterのコピーも増えるため、
+        # 有効patchが7/8以下のときのみ使う(CPUでの計測では全patch有効時は密な経路より約10%遅く、損益分岐は約94%)。
+        # allow_sparse=Falseの場合(固定shapeが必要な場合や全patchが有効と分かっている場合)はsyncせずに常に密な経路とする。
+        valid_mask = input_mask.bool()
+        dtype = torch.promote_types(time_series_features.dtype, self.mask_embedding.dtype)
+        if allow_sparse:
+            valid_indices = valid_mask.reshape(-1).nonzero().squeeze(-1)
+            if valid_indices.numel() * 8 <= valid_mask.numel() * 7:
+                valid_hidden_states = self._project(
+                    time_series_features.reshape(-1, time_series_features.shape[-1]).index_select(0, valid_indices).to(dtype)
+                )
+                masked_hidden_states = self._project(self.mask_embedding.to(dtype)).reshape(1, -1)
+                hidden_states = masked_hidden_states.expand(valid_mask.numel(), -1).index_copy(
+                    0, valid_indices, valid_hidden_states
+                )
+                return hidden_states.reshape(*input_mask.shape, -1)
+
+        masked_features = torch.where(valid_mask.unsqueeze(-1), time_series_features, self.mask_embedding)
+        return self._project(masked_features)
+
+    def _project(self, features):
+        # biasはaddmmとしてGEMMに融合済み。activationのepilogue融合はモデル全体をtorch.compileする側に任せる。
+        hidden_states = self.linear_1(features)
         hidden_states = self.act(hidden_states)
         hidden_states = self.linear_2(hidden_states)
         return hidden_states
@@ -85,6 +115,8 @@ class MistsForConditionalGeneration(MistsPreTrainedModel):
         self.time_series_tower = MomentEmbeddingModel(config.time_series_config)
         self.multi_modal_projector = MistsMultiModalProjector(config)
         self.vocab_size = config.text_config.vocab_size
+        # config._attn_implementationはPreTrainedModel.__init__で解決済み(未指定ならSDPA、FA2は明示指定時のみ)。
+        # FA2はfp16/bf16かつCUDAでしか動作しないため、ここで自動的に選択することはしない。
         self.language_model = AutoModelForCausalLM.from_config(
             config.text_config, attn_implementation=config._attn_implementation
         )
@@ -125,19 +157,68 @@ class MistsForConditionalGeneration(MistsPreTrainedModel):
         self.vocab_size = model_embeds.num_embeddings
         return model_embeds
     
+    def _get_merge_buffer(self, name, shape, dtype, device, fill_value, reuse_buffers):
+        # reuse_buffers=Trueの場合、前回のforwardで確保したバッファを再利用してallocatorへの負荷を減らす。
+        # 返すTensorは次回のforwardで上書きされるため、autogradや呼び出し元に残らない推論時にのみ使用する。
+        # バッファはthreadごとに保持するため、同じモデルを複数threadから推論に使っても互いに上書きしない。
+        # バッファはthreadが終了するかclear_merge_buffersを呼ぶまで保持されるため、再利用はconfig.reuse_merge_buffersで明示的に有効にする。
+        if not reuse_buffers:
+            return torch.full(shape, fill_value, dtype=dtype, device=device)
+        if not hasattr(_merge_buffers, "models"):
+            _merge_buffers.models = weakref.WeakKeyDictionary()
+        buffers = _merge_buffers.models.setdefault(self, {})
+        numel = math.prod(shape)
+        buffer = buffers.get(name)
+        if (
+            buffer is None
+            or buffer.numel() < numel
+            or buffer.dtype != dtype
+            or buffer.device != torch.device(device)
+            # inference_mode下で確保したTensorはその外でin-place更新できない(逆も同様に扱う)
+            or buffer.is_inference() != torch.is_inference_mode_enabled()
+        ):
+            size = numel if buffer is None else max(numel, int(buffer.numel() * 1.5))
+            buffer = torch.empty(size, dtype=dtype, device=device)
+            buffers[name] = buffer
+        return buffer[:numel].view(shape).fill_(fill_value)
+
+    def clear_merge_buffers(self):
+        # 現在のthreadで保持しているmergeの出力バッファを解放する
+        if hasattr(_merge_buffers, "models"):
+            _merge_buffers.models.pop(self, None)
+
     # copy _merge_input_ids_with_image_features from LlabaForConditionalGeneration
     # refers: https://github.com/huggingface/transformers/blob/25245ec26dc29bcf6102e1b4ddd0dfd02e720cf5/src/transformers/models/llava/modeling_llava.py#L277C9-L277C45
-    def _merge_input_ids_with_time_series_features(self, time_series_features, inputs_embeds, input_ids, attention_mask, labels):
+    def _merge_input_ids_with_time_series_features(
+        self, time_series_features, inputs_embeds, input_ids, attention_mask, labels, reuse_buffers=False
+    ):
         num_time_series, num_time_series_patches, embed_dim = time_series_features.shape  # num_time_series_patches = n_channels x n_patches
         batch_size, sequence_length = input_ids.shape
-        left_padding = not torch.sum(input_ids[:, -1] == torch.tensor(self.pad_token_id))
+        # left paddingかどうかはTensorのまま保持し、Pythonで分岐させずにoffsetとして扱う
+        left_padding = (input_ids[:, -1] != self.pad_token_id).all()
         # 1. Create a mask to know where special time_series tokens are
         special_time_series_token_mask = input_ids == self.config.time_series_token_index
         num_special_time_series_tokens = torch.sum(special_time_series_token_mask, dim=-1)
+        # 入力の検証とmax_embed_dimの決定に必要な値を1回のhost-device syncでまとめて取得する(mergeでのsyncはこの1回のみ)。
+        # time_series_input_maskが渡されmax_time_series_tokensが未設定の場合は、projectorの疎密判定でもprefillごとに1回syncする。
+        total_time_series_tokens, max_time_series_tokens = torch.stack(
+            [num_special_time_series_tokens.sum(), num_special_time_series_tokens.max()]
+        ).tolist()
+        if total_time_series_tokens != num_time_series:
+            raise ValueError(
+                f"The input provided to the model are wrong. The number of time series tokens is {total_time_series_tokens} while"
+                f" the number of time series given to the model is {num_time_series}. This prevents correct indexing and breaks batch generation."
+            )
         # Compute the maximum embed dimension
-        max_embed_dim = (num_special_time_series_tokens.max() * (num_time_series_patches - 1)) + sequence_length
-        max_embed_dim = int(max_embed_dim.item())  # テンソルから整数値を取得
-        batch_indices, non_time_series_indices = torch.where(input_ids != self.config.time_series_token_index)
+        # max_time_series_tokensが設定されている場合は、入力に依らない固定のshapeとする(torch.compile/CUDA Graph向け)。
+        if self.config.max_time_series_tokens is not None:
+            if max_time_series_tokens > self.config.max_time_series_tokens:
+                raise ValueError(
+                    f"The number of time series tokens per sample ({max_time_series_tokens}) exceeds `max_time_series_tokens`"
+                    f" ({self.config.max_time_series_tokens}). Increase `max_time_series_tokens` in the config or set it to None."
+                )
+            max_time_series_tokens = self.config.max_time_series_tokens
+        max_embed_dim = max_time_series_tokens * (num_time_series_patches - 1) + sequence_length
 
         # 2. Compute the positions where text should be written
         # Calculate new positions for text tokens in merged time_series-text sequence.
@@ -146,66 +227,89 @@ class MistsForConditionalGeneration(MistsPreTrainedModel):
         # - 1 to adjust for zero-based indexing, as `cumsum` inherently increases indices by one.
         new_token_positions = torch.cumsum((special_time_series_token_mask * (num_time_series_patches - 1) + 1), -1) - 1
         nb_time_series_pad = max_embed_dim - 1 - new_token_positions[:, -1]
-        if left_padding:
-            new_token_positions += nb_time_series_pad[:, None]  # offset for left padding
-        text_to_overwrite = new_token_positions[batch_indices, non_time_series_indices]
+        padding_offset = nb_time_series_pad * left_padding  # offset for left padding, 0 for right padding
+        new_token_positions += padding_offset[:, None]
 
         # 3. Create the full embedding, already padded to the maximum position
-        final_embedding = torch.zeros(
-            batch_size, max_embed_dim, embed_dim, dtype=inputs_embeds.dtype, device=inputs_embeds.device
+        final_embedding = self._get_merge_buffer(
+            "embedding", (batch_size, max_embed_dim, embed_dim), inputs_embeds.dtype, inputs_embeds.device, 0, reuse_buffers
         )
-        final_attention_mask = torch.zeros(
-            batch_size, max_embed_dim, dtype=attention_mask.dtype, device=inputs_embeds.device
+        final_attention_mask = self._get_merge_buffer(
+            "attention_mask", (batch_size, max_embed_dim), attention_mask.dtype, inputs_embeds.device, 0, reuse_buffers
         )
         if labels is not None:
-            final_labels = torch.full(
-                (batch_size, max_embed_dim), self.config.ignore_index, dtype=input_ids.dtype, device=input_ids.device
+            final_labels = self._get_merge_buffer(
+                "labels", (batch_size, max_embed_dim), input_ids.dtype, input_ids.device, self.config.ignore_index, reuse_buffers
             )
         # In case the Vision model or the Language model has been offloaded to CPU, we need to manually
         # set the corresponding tensors into their correct target device.
         target_device = inputs_embeds.device
-        batch_indices, non_time_series_indices, text_to_overwrite = (
-            batch_indices.to(target_device),
-            non_time_series_indices.to(target_device),
-            text_to_overwrite.to(target_device),
-        )
+        new_token_positions, padding_offset = new_token_positions.to(target_device), padding_offset.to(target_device)
+        non_time_series_token_mask = ~special_time_series_token_mask.to(target_device)
         attention_mask = attention_mask.to(target_device)
 
-        # 4. Fill the embeddings based on the mask. If we have ["hey" "<time_series>", "how", "are"]
-        # we need to index copy on [0, 577, 578, 579] for the text and [1:576] for the time_series features
-        final_embedding[batch_indices, text_to_overwrite] = inputs_embeds[batch_indices, non_time_series_indices]
-        final_attention_mask[batch_indices, text_to_overwrite] = attention_mask[batch_indices, non_time_series_indices]
+        # 4. Fill the text positions based on the mask. If we have ["hey" "<time_series>", "how", "are"]
+        # we need to index copy on [0, 577, 578, 579] for the text and [1:576] for the time_series features.
+        # Every token owns exactly one position in `new_token_positions`, so scattering the text mask into it marks the text slots.
+        text_to_overwrite_mask = torch.zeros(
+            (batch_size, max_embed_dim), dtype=torch.bool, device=target_device
+        ).scatter_(1, new_token_positions, non_time_series_token_mask)
+        # All tokens are copied with a single linearized index shared by the embedding, attention mask and labels.
+        # A time_series token lands on the last slot of its own block, which step 5 overwrites afterwards.
+        flat_token_positions = (
+            torch.arange(batch_size, device=target_device)[:, None] * max_embed_dim + new_token_positions
+        ).reshape(-1)
+        # Padding tokens are written as zeros, as we later use the past_key_value value to determine the non-attended tokens.
+        text_embeds = inputs_embeds.masked_fill((input_ids == self.pad_token_id).unsqueeze(-1).to(target_device), 0)
+        final_embedding.view(-1, embed_dim).index_copy_(0, flat_token_positions, text_embeds.reshape(-1, embed_dim))
+        final_attention_mask.view(-1).index_copy_(0, flat_token_positions, attention_mask.reshape(-1))
         if labels is not None:
-            final_labels[batch_indices, text_to_overwrite] = labels[batch_indices, non_time_series_indices]
+            final_labels.view(-1).index_copy_(
+                0, flat_token_positions.to(final_labels.device), labels.reshape(-1).to(final_labels.dtype)
+            )
 
         # 5. Fill the embeddings corresponding to the time_series. Anything that is not `text_positions` needs filling (#29835)
-        time_series_to_overwrite = torch.full(
-            (batch_size, max_embed_dim), True, dtype=torch.bool, device=inputs_embeds.device
+        # max_embed_dim may exceed a sample's merged length, so only the span actually covered by each sample may hold time_series
+        positions = torch.arange(max_embed_dim, device=target_device)
+        time_series_to_overwrite = (
+            (positions >= padding_offset[:, None]) & (positions <= new_token_positions[:, -1:]) & ~text_to_overwrite_mask
         )
-        time_series_to_overwrite[batch_indices, text_to_overwrite] = False
-        time_series_to_overwrite &= time_series_to_overwrite.cumsum(-1) - 1 >= nb_time_series_pad[:, None].to(target_device)
 
-        if time_series_to_overwrite.sum() != time_series_features.shape[:-1].numel():
-            raise ValueError(
-                f"The input provided to the model are wrong. The number of time series tokens is {torch.sum(special_time_series_token_mask)} while"
-                f" the number of time series given to the model is {num_time_series}. This prevents correct indexing and breaks batch generation."
-            )
-
-        final_embedding[time_series_to_overwrite] = time_series_features.contiguous().reshape(-1, embed_dim).to(target_device)
+        final_embedding.masked_scatter_(
+            time_series_to_overwrite.unsqueeze(-1), time_series_features.to(device=target_device, dtype=final_embedding.dtype)
+        )
+        # padding位置はfinal_attention_maskで0となる。flash_attention_2ではlanguage_model側がこのmaskから
+        # cu_seqlensを作りflash_attn_varlen_funcを呼ぶため、padding位置のattention計算は行われない。
         final_attention_mask |= time_series_to_overwrite
+        if labels is not None:
+            final_labels.masked_fill_(time_series_to_overwrite.to(final_labels.device), self.config.ignore_index)
         position_ids = (final_attention_mask.cumsum(-1) - 1).masked_fill_((final_attention_mask == 0), 1)
 
-        # 6. Mask out the embedding at padding positions, as we later use the past_key_value value to determine the non-attended tokens.
-        batch_indices, pad_indices = torch.where(input_ids == self.pad_token_id)
-        indices_to_mask = new_token_positions[batch_indices, pad_indices]
-
-        final_embedding[batch_indices, indices_to_mask] = 0
-
         if labels is None:
             final_labels = None
 
         return final_embedding, final_attention_mask, final_labels, position_ids
     
+    def _get_decode_attention_mask(self, past_key_values, attention_mask, target_length):
+        # generation with cache時のattention_maskとposition_idsを作成する。
+        # 入力に依存しない固定shapeの演算のみで構成し、torch.compileやCUDA Graphでcaptureできるようにしている。
+
+        # Retrieve the first layer to inspect the logits and mask out the hidden states
+        # that are set to 0
+        first_layer_past_key_value = past_key_values[0][0][:, :, :, 0]
+
+        # Check all heads (-2) to avoid random errors such as: https://github.com/huggingface/transformers/pull/28032#issuecomment-1863691941
+        # A position is attended unless every head is exactly zero; the boolean reduction avoids casting the cache to fp32.
+        # cacheの部分と新しいtokenの部分を1つのTensorに直接書き込み、torch.ones/torch.catによる中間Tensorの確保を避ける
+        past_length = first_layer_past_key_value.shape[-1]
+        extended_attention_mask = attention_mask.new_empty((attention_mask.shape[0], past_length + target_length))
+        # Zero-out the places where we don't need to attend
+        extended_attention_mask[:, :past_length] = first_layer_past_key_value.ne(0).any(dim=-2)
+        extended_attention_mask[:, past_length:] = attention_mask[:, -target_length:]
+
+        position_ids = torch.sum(extended_attention_mask, dim=1, keepdim=True) - 1
+        return extended_attention_mask, position_ids
+
     def forward(
         self,
         input_ids: torch.LongTensor = None,
@@ -240,59 +344,49 @@ class MistsForConditionalGeneration(MistsPreTrainedModel):
         # )
 
         if inputs_embeds is None:
+            prefill_time_series = time_series_values is not None and input_ids.shape[1] != 1
+            # time_series_valuesが空の場合のみtime_series_towerの実行とmergeを省略する(shapeはhost側で分かるためsyncは発生しない)。
+            # それ以外はmergeを通し、time_series token数との不一致はmerge内の検証でエラーにする。
+            merge_time_series = prefill_time_series and time_series_values.shape[0] != 0
+
             # 1. Extra the input embeddings
             inputs_embeds = self.get_input_embeddings()(input_ids)
 
             # 2. Merge text and time_series
-            if time_series_values is not None and input_ids.shape[1] != 1:
+            if merge_time_series:
                 time_series_outputs = self.time_series_tower(time_series_values, time_series_input_mask)
                 time_series_features = self.multi_modal_projector(
                     time_series_features=time_series_outputs.hidden_states,  # [batch_size, n_patches, d_model]
                     input_mask=time_series_outputs.input_mask_patch_view,    # [batch_size, n_paches]
+                    # time_series_input_maskがない場合は全patchが有効。固定shapeが必要な場合と同様にsyncのない密な経路を使う。
+                    allow_sparse=self.config.max_time_series_tokens is None and time_series_input_mask is not None,
                 )
 
-                inputs_embeds = inputs_embeds.to(time_series_features.dtype)
+                # time_series_featuresはmerge内でlanguage_modelのembedding dtypeに揃えられる
+                # hidden_statesとして返される場合やbackwardで参照される場合はバッファを再利用しない
+                if output_hidden_states is None:
+                    output_hidden_states = self.language_model.config.output_hidden_states
+                reuse_buffers = self.config.reuse_merge_buffers and not torch.is_grad_enabled() and not output_hidden_states
                 inputs_embeds, attention_mask, labels, position_ids =self._merge_input_ids_with_time_series_features(
-                    time_series_features, inputs_embeds, input_ids, attention_mask, labels
+                    time_series_features, inputs_embeds, input_ids, attention_mask, labels, reuse_buffers=reuse_buffers
                 )
 
+            elif prefill_time_series:
+                # merge同様にpadding位置のembeddingを0にする。generation時にcacheの値からnon-attended tokenを判定するため。
+                inputs_embeds = inputs_embeds.masked_fill((input_ids == self.pad_token_id).unsqueeze(-1), 0)
+
             # In case input_ids.shape[1] == 1 & time_series_values==None & past_key_values != None, we are in the case of
             # generation with cache
             elif past_key_values is not None and time_series_values is not None and input_ids.shape[1] == 1:
-                # Retrieve the first layer to inspect the logits and mask out the hidden states
-                # that are set to 0
-                first_layer_past_key_value = past_key_values[0][0][:, :, :, 0]
-
-                # Sum all dimensions of head_dim (-2) to avoid random errors such as: https://github.com/huggingface/transformers/pull/28032#issuecomment-1863691941
-                batch_index, non_attended_tokens = torch.where(first_layer_past_key_value.float().sum(-2) == 0)
-
-                # Get the target length
-                target_length = input_ids.shape[1]
-                past_length = first_layer_past_key_value.shape[-1]
-
-                extended_attention_mask = torch.ones(
-                    (attention_mask.shape[0], past_length),
-                    dtype=attention_mask.dtype,
-                    device=attention_mask.device,
+                attention_mask, position_ids = self._get_decode_attention_mask(
+                    past_key_values, attention_mask, target_length=input_ids.shape[1]
                 )
 
-                # Filter out only the tokens that can be un-attended, this can happen
-                # if one uses Llava + Fused modules where the cache on the
-                # first iteration is already big enough, or if one passes custom cache
-                valid_indices = non_attended_tokens < extended_attention_mask.size(-1)
-                new_batch_index = batch_index[valid_indices]
-                new_non_attended_tokens = non_attended_tokens[valid_indices]
-
-                # Zero-out the places where we don't need to attend
-                extended_attention_mask[new_batch_index, new_non_attended_tokens] = 0
-
-                attention_mask = torch.cat((extended_attention_mask, attention_mask[:, -target_length:]), dim=1)
-                position_ids = torch.sum(attention_mask, dim=1).unsqueeze(-1) - 1
-            
         outputs = self.language_model(
             attention_mask=attention_mask,
             position_ids=position_ids,
             past_key_values=past_key_values,
+            # mergeを経由した場合はembeddingのdtypeのままなので変換は発生しない。呼び出し元から渡されたinputs_embeds向け。
             inputs_embeds=inputs_embeds.to(self.language_model.dtype),
             use_cache=use_cache,
             output_attentions=output_attentions,
@@ -305,17 +399,17 @@ class MistsForConditionalGeneration(MistsPreTrainedModel):
         loss = None
         if labels is not None:
             # Shift so that tokens < n predict n
+            # logitsをsliceしてコピーする代わりにlabelsを1つずらし、予測対象のない位置はignore_indexで無視する
+            shift_labels = torch.full_like(labels, self.config.ignore_index)
+            shift_labels[..., :-1] = labels[..., 1:]
             if attention_mask is not None:
                 shift_attention_mask = attention_mask[..., 1:]
-                shift_logits = logits[..., :-1, :][shift_attention_mask.to(logits.device) != 0].contiguous()
-                shift_labels = labels[..., 1:][shift_attention_mask.to(labels.device) != 0].contiguous()
-            else:
-                shift_logits = logits[..., :-1, :].contiguous()
-                shift_labels = labels[..., 1:].contiguous()
+                shift_labels[..., :-1].masked_fill_(shift_attention_mask.to(labels.device) == 0, self.config.ignore_index)
             # Flatten the tokens
-            loss_fct = nn.CrossEntropyLoss()
-            loss = loss_fct(
-                shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1).to(shift_logits.device)
+            loss = nn.functional.cross_entropy(
+                logits.reshape(-1, logits.size(-1)),
+                shift_labels.reshape(-1).to(logits.device),
+                ignore_index=self.config.ignore_index,
             )
 
         if not return_dict:
@@ -351,7 +445,9 @@ class MistsForConditionalGeneration(MistsPreTrainedModel):
             elif past_length < input_ids.shape[1]:
                 input_ids = input_ids[:, past_length:]
             # 3 - Otherwise (past_length >= input_ids.shape[1]), let's assume input_ids only has unprocessed tokens.
-            elif self.config.time_series_token_index in input_ids:
+            # cacheがinput_idsより長くなるのはtime_series tokenが展開された場合のみのため、毎stepでinput_ids全体を走査する
+            # `time_series_token_index in input_ids`の代わりにtime_series_valuesの有無で判定する。
+            elif time_series_values is not None:
                 input_ids = input_ids[:, input_ids.shape[1] - 1 :]
             # If the cache has seen more tokens than it can hold, then the cache has a size limit. Let's discard the
             # older attention values, as their corresponding values are not part of the input.